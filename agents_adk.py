@@ -7,27 +7,119 @@ import pandas as pd
 import numpy as np
 import logging
 import io
+import os
 import json
-from typing import Dict, Any, List
+import re
+import hashlib
+import sqlite3
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Any, List, Optional, Tuple
 from google.cloud import storage, bigquery
+from google.api_core.exceptions import NotFound
 import vertexai
-from vertexai.generative_models import GenerativeModel, Part, Tool, FunctionDeclaration
+from vertexai.generative_models import GenerativeModel, GenerationConfig, Part, Tool, FunctionDeclaration
 from vertexai.preview import reasoning_engines
 
+try:
+    from numba import njit
+except ImportError:  # numba is optional - fall back to NumPy below
+    njit = None
+
+try:
+    import orjson
+except ImportError:  # orjson is optional - fall back to the stdlib json module
+    orjson = None
+
+
+# Shared Google Cloud clients: one auth token / HTTP connection pool per process
+# instead of one per agent instance
+_CLIENT_LOCK = threading.Lock()
+_STORAGE_CLIENT = None
+_BQ_CLIENTS: Dict[str, bigquery.Client] = {}
+_GEMINI_MODELS: Dict[Tuple[str, Optional[str]], GenerativeModel] = {}
+_VERTEX_CONFIG = None
+
+
+def init_vertexai(project_id: str, location: str):
+    """Initialize the Vertex AI SDK, skipping the call when it is already set up for this project/location"""
+    global _VERTEX_CONFIG
+    with _CLIENT_LOCK:
+        if _VERTEX_CONFIG != (project_id, location):
+            # gRPC keeps one long-lived HTTP/2 channel (and cached token) per client
+            # instead of a fresh HTTPS request chain per REST call
+            vertexai.init(project=project_id, location=location, api_transport="grpc")
+            _VERTEX_CONFIG = (project_id, location)
+            _GEMINI_MODELS.clear()
+
+
+def gemini_model(model_name: str = "gemini-2.5-flash", system_instruction: Optional[str] = None) -> GenerativeModel:
+    """Process-wide Gemini model per (name, system instruction), so callers share one prediction channel"""
+    key = (model_name, system_instruction)
+    with _CLIENT_LOCK:
+        if key not in _GEMINI_MODELS:
+            _GEMINI_MODELS[key] = GenerativeModel(model_name, system_instruction=system_instruction)
+        return _GEMINI_MODELS[key]
+
+
+def _storage_client() -> storage.Client:
+    """Process-wide GCS client, created on first use"""
+    global _STORAGE_CLIENT
+    with _CLIENT_LOCK:
+        if _STORAGE_CLIENT is None:
+            _STORAGE_CLIENT = storage.Client()
+        return _STORAGE_CLIENT
+
+
+def _bigquery_client(project_id: str) -> bigquery.Client:
+    """Process-wide BigQuery client per project, created on first use"""
+    with _CLIENT_LOCK:
+        if project_id not in _BQ_CLIENTS:
+            _BQ_CLIENTS[project_id] = bigquery.Client(project=project_id)
+        return _BQ_CLIENTS[project_id]
+
+
+def to_json(obj: Any, indent: bool = False) -> str:
+    """Serialize obj for prompts and logs (orjson when installed); unknown types fall back to str()"""
+    if orjson is not None:
+        option = orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=str, option=option).decode()
+    return json.dumps(obj, indent=2 if indent else None, default=str)
+
+
+# gemini-2.5-flash rejects requests asking for more output tokens than this
+GEMINI_MAX_OUTPUT_TOKENS = 65536
+
 
 class BaseAgent:
     """Base class for all ADK agents with Gemini reasoning"""
     
     def __init__(self, project_id: str, location: str = "us-central1"):
-        vertexai.init(project=project_id, location=location)
+        init_vertexai(project_id, location)
         # Use gemini-pro which is widely available
         # Alternative: "gemini-1.5-flash" or "gemini-1.0-pro"
-        self.model = GenerativeModel("gemini-2.5-flash")
+        self.model = gemini_model("gemini-2.5-flash")
         self.project_id = project_id
+        self.location = location
+    
+    def __getstate__(self) -> Dict[str, Any]:
+        """Pickle without the Gemini model (its gRPC channel can't cross into a worker process)"""
+        state = self.__dict__.copy()
+        state.pop('model', None)
+        return state
+    
+    def __setstate__(self, state: Dict[str, Any]):
+        """Reattach the process-wide Gemini model after unpickling"""
+        self.__dict__.update(state)
+        init_vertexai(self.project_id, self.location)
+        self.model = gemini_model("gemini-2.5-flash")
         
-    def reason(self, context: str, question: str) -> str:
-        """Use Gemini to reason about a situation"""
-        prompt = f"""
+    def _prompt(self, context: str, question: str) -> str:
+        """Wrap a context and question in the shared data-engineer prompt"""
+        return f"""
 You are an expert data engineer agent. Analyze the following context and answer the question.
 
 Context:
@@ -37,8 +129,226 @@ Question: {question}
 
 Provide a concise, actionable response based on best practices.
 """
-        response = self.model.generate_content(prompt)
-        return response.text
+    
+    def reason(self, context: str, question: str, max_chars: Optional[int] = None,
+               max_output_tokens: Optional[int] = None) -> str:
+        """
+        Use Gemini to reason about a situation
+        max_chars: stream the response and stop reading (ending decoding early) once
+        this many characters have arrived - for callers that only use a prefix
+        max_output_tokens: server-side decode budget
+        """
+        prompt = self._prompt(context, question)
+        generation_config = GenerationConfig(max_output_tokens=max_output_tokens) if max_output_tokens else None
+        if max_chars is None:
+            response = self.model.generate_content(prompt, generation_config=generation_config)
+            return response.text
+        
+        chunks = []
+        received = 0
+        for chunk in self.model.generate_content(prompt, generation_config=generation_config, stream=True):
+            try:
+                text = chunk.text
+            except ValueError:  # chunk without text parts (e.g. only a finish reason)
+                continue
+            chunks.append(text)
+            received += len(text)
+            if received >= max_chars:
+                break
+        return "".join(chunks)
+    
+    def reason_json(self, context: str, question: str, schema: Dict[str, Any],
+                    max_output_tokens: Optional[int] = None) -> Dict[str, Any]:
+        """Use Gemini structured output to answer with a JSON object matching schema"""
+        response = self.model.generate_content(
+            self._prompt(context, question),
+            generation_config=GenerationConfig(
+                response_mime_type="application/json",
+                response_schema=schema,
+                max_output_tokens=max_output_tokens
+            )
+        )
+        return json.loads(response.text)
+    
+    def reason_batch(self, contexts: List[Tuple[str, str]],
+                     schema: Optional[Dict[str, Any]] = None,
+                     max_output_tokens: Optional[int] = None) -> List[Any]:
+        """
+        Use Gemini to reason about several (context, question) pairs in a single round trip
+        Returns one answer per pair, in order: strings, or objects matching schema if given
+        ("" / {} for any the model left out, or all of them if the response can't be parsed)
+        max_output_tokens: decode budget per answer (scaled by the batch size; batches whose
+        total would pass GEMINI_MAX_OUTPUT_TOKENS are split into several calls)
+        """
+        if not contexts:
+            return []
+        if max_output_tokens:
+            max_output_tokens = min(max_output_tokens, GEMINI_MAX_OUTPUT_TOKENS)
+            per_call = GEMINI_MAX_OUTPUT_TOKENS // max_output_tokens
+            if len(contexts) > per_call:
+                return [
+                    answer
+                    for start in range(0, len(contexts), per_call)
+                    for answer in self.reason_batch(contexts[start:start + per_call], schema, max_output_tokens)
+                ]
+        answers = [{} if schema is not None else ""] * len(contexts)
+        if len(contexts) == 1:
+            if schema is not None:
+                try:
+                    return [self.reason_json(*contexts[0], schema, max_output_tokens)]
+                except ValueError as e:  # truncated / blocked response
+                    logging.warning(f"⚠️  Unreadable Gemini response, using an empty answer: {e}")
+                    return answers
+            return [self.reason(*contexts[0], max_output_tokens=max_output_tokens)]
+        
+        sections = "\n".join(
+            f"""### FILE {i}
+Context:
+{context}
+
+Question: {question}
+"""
+            for i, (context, question) in enumerate(contexts, start=1)
+        )
+        prompt = f"""
+You are an expert data engineer agent. Analyze each of the following {len(contexts)} files and answer its question.
+
+{sections}
+Provide a concise, actionable response for each file based on best practices.
+Return a JSON array with exactly one object per file, in order:
+[{{"file": <file number>, "answer": "<response>"}}, ...]
+"""
+        response = self.model.generate_content(
+            prompt,
+            generation_config=GenerationConfig(
+                response_mime_type="application/json",
+                response_schema={
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {
+                            "file": {"type": "integer"},
+                            "answer": schema if schema is not None else {"type": "string"}
+                        },
+                        "required": ["file", "answer"]
+                    }
+                },
+                max_output_tokens=max_output_tokens * len(contexts) if max_output_tokens else None
+            )
+        )
+        
+        try:
+            items = json.loads(response.text)
+        except ValueError as e:  # truncated / blocked response
+            logging.warning(f"⚠️  Unreadable batched Gemini response, using empty answers: {e}")
+            return answers
+        
+        for pos, item in enumerate(items if isinstance(items, list) else []):
+            if not isinstance(item, dict):
+                continue
+            try:
+                idx = int(item.get("file", pos + 1)) - 1
+            except (TypeError, ValueError):
+                idx = pos
+            if 0 <= idx < len(answers):
+                answers[idx] = item.get("answer", answers[idx])
+        return answers
+
+
+# File extensions whose format is known without asking Gemini
+EXT_FORMATS = {
+    ".csv": "csv",
+    ".json": "json",
+    ".jsonl": "json",
+    ".ndjson": "json"
+}
+
+# Explicit dtypes for known identifier/text columns so the C parser skips inference on them
+# (columns missing from a file are ignored)
+CSV_DTYPE_HINTS = {
+    "order_id": str,
+    "customer_id": str,
+    "order_date": str,
+    "status": str
+}
+
+# Month-name alternation compiled once; the regex engine scans each date string in a single pass
+MONTH_RE = re.compile(r'Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec')
+
+# GCS read buffer size when streaming a blob into the parser
+STREAM_CHUNK_SIZE = 8 * 1024 * 1024
+
+# Total bytes IngestionAgent.prefetch() may hold in memory; files past it are streamed instead
+PREFETCH_MAX_BYTES = 64 * 1024 * 1024
+
+
+if njit is not None:
+    # Files are cleaned concurrently on pipeline threads, so release the GIL rather than use
+    # parallel=True (numba's default workqueue layer hangs when launched off the main thread)
+    @njit(nogil=True, cache=True)
+    def cap_and_count(arr, threshold, cap):
+        """
+        Single pass over a float64 buffer: fill NaNs with 0, cap values above threshold,
+        and return (outlier_count, null_count). Modifies arr in place.
+        """
+        outliers = 0
+        nulls = 0
+        for i in range(arr.size):
+            v = arr[i]
+            if np.isnan(v):
+                nulls += 1
+                arr[i] = 0.0
+            elif v > threshold:
+                outliers += 1
+                arr[i] = cap
+        return outliers, nulls
+else:
+    def cap_and_count(arr, threshold, cap):
+        """
+        NumPy fallback: fill NaNs with 0, cap values above threshold,
+        and return (outlier_count, null_count). Modifies arr in place.
+        """
+        nulls = np.isnan(arr)
+        outliers = arr > threshold
+        arr[nulls] = 0.0
+        arr[outliers] = cap
+        return int(outliers.sum()), int(nulls.sum())
+
+
+class SchemaMemory:
+    """
+    SQLite-backed cache of Gemini schema analyses, keyed by schema fingerprint
+    so repeat runs on known schemas skip the LLM round trip
+    """
+    
+    def __init__(self, db_path: str = "schema_memory.db"):
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS schema_memory "
+            "(fingerprint TEXT PRIMARY KEY, fmt TEXT, analysis TEXT, ts REAL)"
+        )
+        self.conn.commit()
+    
+    @staticmethod
+    def fingerprint(ext: str, columns: List[str], dtypes) -> str:
+        """Stable hash of file extension + sorted column list + dtype tuple"""
+        raw = f"{ext}|{','.join(sorted(columns))}|{tuple(dtypes)}"
+        return hashlib.blake2b(raw.encode()).hexdigest()
+    
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached analysis for a key, or None on a miss"""
+        row = self.conn.execute(
+            "SELECT analysis FROM schema_memory WHERE fingerprint = ?", (key,)
+        ).fetchone()
+        return row[0] if row else None
+    
+    def put(self, key: str, fmt: str, analysis: str):
+        """Persist an analysis, replacing any previous entry for the key"""
+        self.conn.execute(
+            "INSERT OR REPLACE INTO schema_memory (fingerprint, fmt, analysis, ts) VALUES (?, ?, ?, ?)",
+            (key, fmt, analysis, time.time())
+        )
+        self.conn.commit()
 
 
 class IngestionAgent(BaseAgent):
@@ -46,11 +356,14 @@ class IngestionAgent(BaseAgent):
     Ingestion Agent powered by Gemini for intelligent schema detection and format handling
     """
     
-    def __init__(self, project_id: str, bucket_name: str, location: str = "us-central1"):
+    def __init__(self, project_id: str, bucket_name: str, location: str = "us-central1",
+                 memory_path: str = "schema_memory.db"):
         super().__init__(project_id, location)
         self.bucket_name = bucket_name
-        self.storage_client = storage.Client()
+        self.storage_client = _storage_client()
         self.last_schema = None
+        self.last_fingerprint = None
+        self.memory = SchemaMemory(memory_path)
         
         # Define tools for the agent
         self.tools = self._setup_tools()
@@ -84,31 +397,88 @@ class IngestionAgent(BaseAgent):
         
         return [Tool(function_declarations=[read_file_func, detect_schema_func])]
     
-    def execute(self, file_name: str) -> Dict[str, Any]:
-        """Execute ingestion with LLM-powered reasoning"""
-        logging.info(f"🤖 Ingestion Agent: Processing {file_name} with Gemini reasoning...")
-        
-        # Step 1: Read file from GCS
+    def prefetch(self, file_names: List[str], max_workers: int = 8,
+                 max_bytes: int = PREFETCH_MAX_BYTES) -> Dict[str, bytes]:
+        """
+        Download several files concurrently (GCS reads are I/O-bound), holding at most max_bytes
+        Files over the budget, or that fail here, are left out and streamed by execute()
+        """
         bucket = self.storage_client.bucket(self.bucket_name)
-        blob = bucket.blob(file_name)
-        content = blob.download_as_text()
+        budget_lock = threading.Lock()
+        remaining = [max_bytes]
+        
+        def fetch(file_name: str) -> Optional[bytes]:
+            blob = bucket.get_blob(file_name)
+            with budget_lock:
+                if blob is None or blob.size is None or blob.size > remaining[0]:
+                    return None
+                remaining[0] -= blob.size
+            return blob.download_as_bytes()
+        
+        contents = {}
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(file_names)))) as executor:
+            futures = {executor.submit(fetch, file_name): file_name for file_name in file_names}
+            for future in as_completed(futures):
+                file_name = futures[future]
+                try:
+                    content = future.result()
+                except Exception as e:
+                    logging.warning(f"⚠️  Prefetch failed for {file_name}, will retry on ingestion: {e}")
+                    continue
+                if content is not None:
+                    contents[file_name] = content
+        return contents
+    
+    def _llm_detect_format(self, fh, file_name: str, ext: str) -> str:
+        """Ask Gemini for the format of a file with an unrecognized extension"""
+        preview = fh.read(500).decode("utf-8", errors="replace")
+        fh.seek(0)
         
-        # Step 2: Auto-detect format with LLM reasoning
         format_context = f"""
 File name: {file_name}
-File extension: {file_name.split('.')[-1]}
-First 500 chars: {content[:500]}
+File extension: {ext}
+First 500 chars: {preview}
 """
         
         format_question = "What is the most likely format of this data file (CSV or JSON)? Consider the file extension and content structure."
         format_decision = self.reason(format_context, format_question)
+        return "csv" if "csv" in format_decision.lower() else "json"
+    
+    def _parse(self, fh, fmt: str, ext: str) -> pd.DataFrame:
+        """Parse an open binary file handle into a DataFrame"""
+        if fmt == "csv":
+            return pd.read_csv(fh, dtype=CSV_DTYPE_HINTS, engine="c", low_memory=False)
+        return pd.read_json(fh, lines=ext in ('.jsonl', '.ndjson'))
+    
+    def execute(self, file_name: str, content: Optional[bytes] = None) -> Dict[str, Any]:
+        """Execute ingestion with LLM-powered reasoning"""
+        logging.info(f"🤖 Ingestion Agent: Processing {file_name} with Gemini reasoning...")
         
-        # Parse the file based on detected format
-        fmt = "csv" if "csv" in format_decision.lower() or file_name.endswith('.csv') else "json"
-        df = pd.read_csv(io.StringIO(content)) if fmt == "csv" else pd.read_json(io.StringIO(content))
+        # Step 1: Open the file - prefetched bytes, or stream straight from GCS
+        # so the whole file is never materialized as a str
+        if content is not None:
+            fh = io.BytesIO(content)
+        else:
+            bucket = self.storage_client.bucket(self.bucket_name)
+            blob = bucket.blob(file_name)
+            fh = blob.open("rb", chunk_size=STREAM_CHUNK_SIZE)
+        
+        with fh:
+            # Step 2: Auto-detect format - the extension is authoritative when known,
+            # only fall back to LLM reasoning for unknown extensions
+            ext = os.path.splitext(file_name)[1].lower()
+            fmt = EXT_FORMATS.get(ext)
+            if fmt is None:
+                fmt = self._llm_detect_format(fh, file_name, ext)
+            
+            # Parse the file based on detected format
+            df = self._parse(fh, fmt, ext)
         
-        # Step 3: Schema analysis with LLM
+        # Step 3: Schema analysis with LLM (cached by schema fingerprint)
+        # Column list and dtype map are computed once here and handed downstream via metadata
         current_schema = df.columns.tolist()
+        data_types = {col: str(dtype) for col, dtype in df.dtypes.items()}
+        fingerprint = SchemaMemory.fingerprint(ext, current_schema, df.dtypes)
         schema_changed = False
         new_cols = []
         schema_analysis = ""
@@ -118,7 +488,7 @@ First 500 chars: {content[:500]}
 Previous schema: {self.last_schema}
 Current schema: {current_schema}
 Data shape: {df.shape}
-Sample data types: {df.dtypes.to_dict()}
+Sample data types: {data_types}
 """
             
             schema_question = """
@@ -129,7 +499,13 @@ Analyze these schemas:
 4. Should we be concerned about any changes?
 """
             
-            schema_analysis = self.reason(schema_context, schema_question)
+            memory_key = f"{self.last_fingerprint}:{fingerprint}"
+            schema_analysis = self.memory.get(memory_key)
+            if schema_analysis is None:
+                schema_analysis = self.reason(schema_context, schema_question)
+                self.memory.put(memory_key, fmt, schema_analysis)
+            else:
+                logging.info("💾 Schema analysis served from memory cache")
             
             # Parse LLM response and update flags
             if current_schema != self.last_schema:
@@ -138,6 +514,7 @@ Analyze these schemas:
                 logging.info(f"🧠 Gemini detected schema change: {schema_analysis}")
         
         self.last_schema = current_schema
+        self.last_fingerprint = fingerprint
         
         # Step 4: Generate metadata report
         metadata = {
@@ -147,7 +524,7 @@ Analyze these schemas:
             "schema_changed": schema_changed,
             "new_columns": new_cols,
             "llm_analysis": schema_analysis,
-            "data_types": df.dtypes.astype(str).to_dict()
+            "data_types": data_types
         }
         
         logging.info(f"✅ Ingestion complete: {len(df)} rows, format={fmt}")
@@ -163,30 +540,59 @@ class QualityAgent(BaseAgent):
     Quality Agent powered by Gemini for intelligent data profiling and issue detection
     """
     
-    def execute(self, df: pd.DataFrame) -> Dict[str, Any]:
-        """Execute quality checks with LLM-powered analysis"""
-        logging.info(f"🤖 Quality Agent: Analyzing {len(df)} rows with Gemini...")
+    # Structured-output schema for the Gemini assessment - only the fields the pipeline uses
+    ASSESSMENT_SCHEMA = {
+        "type": "object",
+        "properties": {
+            "score": {"type": "integer"},
+            "severity": {"type": "string", "enum": ["low", "medium", "high"]},
+            "recommendation": {"type": "string"}
+        },
+        "required": ["score", "severity", "recommendation"]
+    }
+    
+    # Decode budget for the assessment: bounds LLM latency while leaving room for
+    # gemini-2.5-flash's thinking tokens, which count against the same limit
+    ASSESSMENT_MAX_TOKENS = 1024
+    
+    def profile(self, df: pd.DataFrame) -> Dict[str, Any]:
+        """
+        Compute the vectors every check reuses in one place: per-column null counts
+        (a single reduction over the null mask), the coerced numeric amount column, and
+        the duplicate mask (by order_id, or exact rows if there is no order_id)
+        """
+        dup_mask = df.duplicated(subset=['order_id']) if 'order_id' in df.columns else df.duplicated()
+        return {
+            "null_counts": df.isnull().values.sum(axis=0),
+            "numeric_amount": pd.to_numeric(df['amount'], errors='coerce') if 'amount' in df.columns else None,
+            "dup_mask": dup_mask.to_numpy()
+        }
+    
+    def detect_issues(self, df: pd.DataFrame, profile: Optional[Dict[str, Any]] = None) -> List[Dict]:
+        """Run the rule-based quality checks and return the issues found"""
+        if profile is None:
+            profile = self.profile(df)
         
         issues = []
         total_rows = len(df)
         
-        # 1. Null Detection
-        null_map = df.isnull().sum()
+        # 1. Null Detection (only visit columns that actually have nulls)
+        null_counts = profile['null_counts']
         null_issues = []
-        for col, count in null_map.items():
-            if count > 0:
-                null_pct = (count / total_rows) * 100
-                null_issues.append({
-                    "type": "nulls", 
-                    "column": col, 
-                    "count": int(count),
-                    "percentage": round(null_pct, 2)
-                })
-                issues.append(null_issues[-1])
+        for idx in np.flatnonzero(null_counts):
+            count = null_counts[idx]
+            null_pct = (count / total_rows) * 100
+            null_issues.append({
+                "type": "nulls", 
+                "column": df.columns[idx], 
+                "count": int(count),
+                "percentage": round(null_pct, 2)
+            })
+            issues.append(null_issues[-1])
         
         # 2. Duplicate Detection (based on order_id - business logic)
+        dup_count = profile['dup_mask'].sum()
         if 'order_id' in df.columns:
-            dup_count = df.duplicated(subset=['order_id']).sum()
             if dup_count > 0:
                 dup_pct = (dup_count / total_rows) * 100
                 issues.append({
@@ -197,7 +603,6 @@ class QualityAgent(BaseAgent):
                 })
         else:
             # Fallback to exact row duplicates if no order_id
-            dup_count = df.duplicated().sum()
             if dup_count > 0:
                 dup_pct = (dup_count / total_rows) * 100
                 issues.append({
@@ -208,8 +613,8 @@ class QualityAgent(BaseAgent):
         
         # 3. Outlier Detection (for amount column)
         outlier_issues = []
-        if 'amount' in df.columns:
-            numeric_amount = pd.to_numeric(df['amount'], errors='coerce')
+        numeric_amount = profile['numeric_amount']
+        if numeric_amount is not None:
             outlier_count = (numeric_amount > 10000).sum()
             if outlier_count > 0:
                 outlier_pct = (outlier_count / total_rows) * 100
@@ -225,16 +630,20 @@ class QualityAgent(BaseAgent):
         # 4. Date Format Validation
         date_issues = []
         if 'order_date' in df.columns:
-            date_sample = df['order_date'].dropna().head(20).tolist()
-            date_formats = set()
+            date_sample = df['order_date'].dropna().head(20).astype(str)
             
-            for date_str in date_sample:
-                if '/' in str(date_str):
-                    date_formats.add("slash_format")
-                elif '-' in str(date_str) and str(date_str).split('-')[0].isdigit() and len(str(date_str).split('-')[0]) == 2:
-                    date_formats.add("day_first_format")
-                elif any(month in str(date_str) for month in ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']):
-                    date_formats.add("text_month_format")
+            # Vectorized checks, keeping the precedence slash > day-first > text month per value
+            slash = date_sample.str.contains('/', regex=False)
+            day_first = ~slash & date_sample.str.match(r'\d{2}-')
+            text_month = ~slash & ~day_first & date_sample.str.contains(MONTH_RE, regex=True)
+            
+            date_formats = {
+                name for name, mask in (
+                    ("slash_format", slash),
+                    ("day_first_format", day_first),
+                    ("text_month_format", text_month)
+                ) if mask.any()
+            }
             
             if len(date_formats) > 1:
                 date_issues.append({
@@ -245,70 +654,119 @@ class QualityAgent(BaseAgent):
                 })
                 issues.append(date_issues[-1])
         
-        # Use Gemini to analyze overall data quality
+        return issues
+    
+    def profile_and_detect(self, df: pd.DataFrame) -> Tuple[Dict[str, Any], List[Dict]]:
+        """profile() + detect_issues() in one call, so a worker process receives df only once"""
+        profile = self.profile(df)
+        return profile, self.detect_issues(df, profile)
+    
+    @staticmethod
+    def _breakdown(issues: List[Dict]) -> Dict[str, Any]:
+        """Group detected issues by category for scoring and prompting"""
+        return {
+            "nulls": [i for i in issues if i['type'] == 'nulls'],
+            "dup_count": sum(i['count'] for i in issues if i['type'] in ('duplicate_orders', 'duplicates')),
+            "outliers": [i for i in issues if i['type'] == 'outliers'],
+            "dates": [i for i in issues if i['type'] == 'inconsistent_date_formats']
+        }
+    
+    def assessment_prompt(self, df: pd.DataFrame, issues: List[Dict],
+                          metadata: Optional[Dict] = None) -> Tuple[str, str]:
+        """
+        Build the Gemini (context, question) pair for an overall quality assessment
+        metadata: ingestion metadata, whose schema / data_types are reused when given
+        """
+        breakdown = self._breakdown(issues)
+        columns = metadata['schema'] if metadata else df.columns.tolist()
+        data_types = metadata['data_types'] if metadata else {col: str(dtype) for col, dtype in df.dtypes.items()}
+        
         quality_context = f"""
 Dataset Overview:
-- Total rows: {total_rows}
-- Columns: {df.columns.tolist()}
-- Data types: {df.dtypes.to_dict()}
+- Total rows: {len(df)}
+- Columns: {columns}
+- Data types: {data_types}
 
 Issues Detected:
-{json.dumps(issues, indent=2)}
+{to_json(issues, indent=True)}
 
 Issue Breakdown:
-- Null values: {len(null_issues)} columns affected
-- Duplicates: {dup_count} rows
-- Outliers: {len(outlier_issues)} columns with extreme values
-- Date format issues: {len(date_issues)} inconsistencies
+- Null values: {len(breakdown['nulls'])} columns affected
+- Duplicates: {breakdown['dup_count']} rows
+- Outliers: {len(breakdown['outliers'])} columns with extreme values
+- Date format issues: {len(breakdown['dates'])} inconsistencies
 """
         
         quality_question = """
 As a data quality expert, provide:
-1. An overall quality assessment (0-100 scale)
-2. Severity rating for each issue category (low/medium/high)
-3. Recommended actions for each issue
-4. Whether this data should proceed to transformation or be rejected
-
-Consider:
-- Null values < 5% = low severity
-- Duplicates < 10% = medium severity
-- Multiple date formats = medium severity
-- Outliers > 5% = high severity
+- score: overall quality assessment (0-100 scale)
+- severity: overall severity of the issues (low/medium/high)
+- recommendation: whether this data should proceed to transformation or be rejected, in one or two sentences
 """
         
-        llm_assessment = self.reason(quality_context, quality_question)
+        return quality_context, quality_question
+    
+    def score_issues(self, issues: List[Dict]) -> int:
+        """Rule-based quality score (consistent and predictable)"""
+        breakdown = self._breakdown(issues)
         
         # Improved scoring logic with weighted penalties
         base_score = 100
         
         # Penalty weights (tuned to meet assessment expectations)
-        null_penalty = len(null_issues) * 5  # 5 points per column with nulls
-        dup_penalty = 10 if dup_count > 0 else 0  # 10 points for any duplicates
-        outlier_penalty = len(outlier_issues) * 8  # 8 points per column with outliers
-        date_penalty = len(date_issues) * 7  # 7 points for date format issues
-        
-        # Calculate rule-based score (consistent and predictable)
-        quality_score = max(0, base_score - null_penalty - dup_penalty - outlier_penalty - date_penalty)
-        
-        # Try to extract LLM score for comparison (logging only)
-        import re
-        llm_score = None
-        score_match = re.search(r'(\d{1,3})\s*(?:/100|%|score)', llm_assessment.lower())
-        if score_match:
-            llm_score = int(score_match.group(1))
+        null_penalty = len(breakdown['nulls']) * 5  # 5 points per column with nulls
+        dup_penalty = 10 if breakdown['dup_count'] > 0 else 0  # 10 points for any duplicates
+        outlier_penalty = len(breakdown['outliers']) * 8  # 8 points per column with outliers
+        date_penalty = len(breakdown['dates']) * 7  # 7 points for date format issues
+        
+        return max(0, base_score - null_penalty - dup_penalty - outlier_penalty - date_penalty)
+    
+    def execute(self, df: pd.DataFrame, issues: Optional[List[Dict]] = None,
+                llm_assessment: Optional[Dict[str, Any]] = None,
+                profile: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Execute quality checks with LLM-powered analysis
+        Precomputed issues / assessment (e.g. from a batched Gemini call) skip those steps
+        """
+        logging.info(f"🤖 Quality Agent: Analyzing {len(df)} rows with Gemini...")
+        
+        if profile is None:
+            profile = self.profile(df)
+        if issues is None:
+            issues = self.detect_issues(df, profile)
+        
+        # Use Gemini to analyze overall data quality
+        if llm_assessment is None:
+            llm_assessment = self.reason_json(
+                *self.assessment_prompt(df, issues), self.ASSESSMENT_SCHEMA, self.ASSESSMENT_MAX_TOKENS
+            )
+        
+        quality_score = self.score_issues(issues)
+        
+        # LLM score is for comparison only (logging)
+        llm_score = llm_assessment.get('score')
+        if llm_score is not None:
             logging.info(f"📊 Score comparison: Rule-based={quality_score}, LLM={llm_score}")
         
         # Use rule-based score for consistency
         # LLM assessment is still valuable for explanations and recommendations
         
         logging.info(f"🧠 Gemini Quality Assessment (Score: {quality_score}/100):")
-        logging.info(f"{llm_assessment[:500]}...")
+        logging.info(f"{llm_assessment.get('severity', 'unknown')} severity - {llm_assessment.get('recommendation', '')}")
+        
+        # Ready-to-print summary of the first 3 issues, so callers don't re-walk the dicts
+        issue_preview = "\n".join(
+            f"   - {issue['type']}: {issue.get('column', 'N/A')} ({issue.get('count', 0)} affected)"
+            for issue in issues[:3]
+        )
         
         return {
             "quality_score": quality_score,
             "issues": issues,
+            "issue_preview": issue_preview,
             "llm_assessment": llm_assessment,
-            "recommendation": "PROCEED" if quality_score >= 60 else "ABORT"
+            "recommendation": "PROCEED" if quality_score >= 60 else "ABORT",
+            "profile": profile
         }
 
 
@@ -317,25 +775,40 @@ class TransformAgent(BaseAgent):
     Transform Agent powered by Gemini for intelligent data cleaning decisions
     """
     
-    def execute(self, df: pd.DataFrame, issues: List[Dict] = None) -> Dict[str, Any]:
-        """Execute transformations with LLM-guided cleaning strategy"""
-        logging.info(f"🤖 Transform Agent: Cleaning {len(df)} rows with Gemini guidance...")
+    # Decode budget for a cleaning strategy (only its first 500 chars are used); leaves room
+    # for gemini-2.5-flash's thinking tokens, which count against the same limit
+    STRATEGY_MAX_TOKENS = 1024
+    
+    def strategy_prompt(self, df: pd.DataFrame, issues: List[Dict],
+                        metadata: Optional[Dict] = None) -> Tuple[str, str]:
+        """
+        Build the Gemini (context, question) pair for planning the cleaning strategy
+        metadata: ingestion metadata, whose schema / data_types are reused when given
+        """
+        columns = metadata['schema'] if metadata else df.columns.tolist()
+        data_types = metadata['data_types'] if metadata else {col: str(dtype) for col, dtype in df.dtypes.items()}
         
-        fixes = []
-        rows_in = len(df)
+        # Per-column stats instead of raw rows keep the prompt O(columns) however wide the frame is
+        null_counts = df.isna().sum()
+        col_profile = {}
+        for col in columns:
+            sample = df[col].dropna().head(1)
+            col_profile[col] = {
+                "dtype": data_types[col],
+                "nulls": int(null_counts[col]),
+                "sample": sample.iloc[0] if len(sample) else None
+            }
         
-        # Use Gemini to plan transformation strategy
-        if issues:
-            transform_context = f"""
+        transform_context = f"""
 Dataset shape: {df.shape}
-Columns: {df.columns.tolist()}
-Issues detected: {json.dumps(issues, indent=2)}
+Columns: {columns}
+Issues detected: {to_json(issues, indent=True)}
 
-Sample data (first 3 rows):
-{df.head(3).to_dict()}
+Column profile (dtype, null count, sample value):
+{to_json(col_profile)}
 """
-            
-            transform_question = """
+        
+        transform_question = """
 As a data transformation expert, recommend the optimal cleaning strategy:
 1. Which issues should be fixed vs which rows should be dropped?
 2. For null values: should we fill with defaults or drop rows?
@@ -345,72 +818,135 @@ As a data transformation expert, recommend the optimal cleaning strategy:
 
 Provide a step-by-step transformation plan.
 """
-            
-            cleaning_strategy = self.reason(transform_context, transform_question)
-            logging.info(f"🧠 Gemini Cleaning Strategy: {cleaning_strategy[:500]}...")
+        
+        return transform_context, transform_question
+    
+    @staticmethod
+    def _parse_dates(dates: pd.Series, date_formats: List[str]) -> pd.Series:
+        """
+        Parse dates through fixed-format C parsers (ISO, plus YYYY/MM/DD and MM/DD/YYYY when
+        QualityAgent saw slash dates) and only send what they can't parse to the slow
+        format='mixed' path
+        """
+        if "slash_format" in date_formats:
+            slash = dates.str.contains('/', regex=False, na=False)
+            year_first = slash & dates.str.match(r'\d{4}/', na=False)
+            month_first = slash & ~year_first
+            parsed = pd.to_datetime(dates.where(~slash), format='%Y-%m-%d', errors='coerce')
+            parsed[year_first] = pd.to_datetime(dates[year_first], format='%Y/%m/%d', errors='coerce')
+            parsed[month_first] = pd.to_datetime(dates[month_first], format='%m/%d/%Y', errors='coerce')
+        else:
+            parsed = pd.to_datetime(dates, format='%Y-%m-%d', errors='coerce')
+        
+        residual = parsed.isna() & dates.notna()
+        if residual.any():
+            parsed[residual] = pd.to_datetime(dates[residual], errors='coerce', format='mixed')
+        
+        return parsed
+    
+    def execute(self, df: pd.DataFrame, issues: List[Dict] = None,
+                cleaning_strategy: Optional[str] = None,
+                profile: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """
+        Execute transformations with LLM-guided cleaning strategy
+        profile: QualityAgent.profile() of df - its coerced amount column and duplicate mask
+        are reused instead of recomputed
+        """
+        logging.info(f"🤖 Transform Agent: Cleaning {len(df)} rows with Gemini guidance...")
+        
+        fixes = []
+        rows_in = len(df)
+        
+        # Use Gemini to plan transformation strategy (unless already planned in a batch;
+        # "" means the batch failed and the clean proceeds without one)
+        if issues:
+            if cleaning_strategy is None:
+                # Only the first 500 chars are used, so stop streaming there
+                cleaning_strategy = self.reason(
+                    *self.strategy_prompt(df, issues), max_chars=500, max_output_tokens=self.STRATEGY_MAX_TOKENS
+                )
+            if cleaning_strategy:
+                logging.info(f"🧠 Gemini Cleaning Strategy: {cleaning_strategy[:500]}...")
         
         # Apply transformations in optimal order
         
+        numeric_amount = profile['numeric_amount'] if profile else None
+        dup_mask = profile['dup_mask'] if profile else None
+        
+        # 0. Coerce amount to numeric once (reusing the quality profile when available);
+        # assign() returns a new frame so the caller's data is left untouched
+        if 'amount' in df.columns:
+            if numeric_amount is None:
+                numeric_amount = pd.to_numeric(df['amount'], errors='coerce')
+            df = df.assign(amount=numeric_amount)
+        
         # 1. Remove Duplicates FIRST (before filling nulls, so we keep better data)
         if 'order_id' in df.columns:
-            dups_before = df.duplicated(subset=['order_id']).sum()
-            
-            # Sort by amount (descending) so rows with data come first
-            # This way, when we keep='first', we keep the row with actual data
-            if 'amount' in df.columns:
-                df = df.sort_values('amount', ascending=False, na_position='last')
-            
-            # Keep the first occurrence (which is now the one with data, if available)
-            df = df.drop_duplicates(subset=['order_id'], keep='first')
-            
-            # Reset index after sorting and deduplication
-            df = df.reset_index(drop=True)
+            if dup_mask is None:
+                dup_mask = df.duplicated(subset=['order_id']).to_numpy()
+            dups_before = dup_mask.sum()
             
             if dups_before > 0:
+                if 'amount' in df.columns:
+                    # Keep the row with the largest amount per order, so rows with data beat
+                    # null amounts (ties go to the first occurrence) - one hash groupby, no full sort
+                    amounts = pd.Series(df['amount'].fillna(-np.inf).to_numpy())
+                    keep_pos = amounts.groupby(df['order_id'].to_numpy(), sort=False, dropna=False).idxmax()
+                    df = df.iloc[keep_pos.to_numpy()]
+                else:
+                    df = df[~dup_mask]
+                
+                # Reset index after deduplication
+                df = df.reset_index(drop=True)
+                
                 fixes.append(f"Removed {dups_before} duplicate orders (kept rows with more data)")
                 logging.info(f"✓ Removed {dups_before} duplicate orders")
         else:
             # Fallback to exact row matching if no order_id column
-            dups_before = df.duplicated().sum()
-            df = df.drop_duplicates()
+            if dup_mask is None:
+                dup_mask = df.duplicated().to_numpy()
+            dups_before = dup_mask.sum()
+            df = df[~dup_mask].reset_index(drop=True)
             if dups_before > 0:
                 fixes.append(f"Removed {dups_before} duplicate records")
                 logging.info(f"✓ Removed {dups_before} duplicates")
         
         # 2. Fix Date Formats - Handle all formats including 'Feb 15 2025'
         if 'order_date' in df.columns:
-            # Use format='mixed' to handle multiple date formats automatically
-            df['order_date'] = pd.to_datetime(df['order_date'], errors='coerce', format='mixed')
-            df['order_date'] = df['order_date'].dt.strftime('%Y-%m-%d')
+            date_formats = next(
+                (i['formats_found'] for i in issues or [] if i['type'] == 'inconsistent_date_formats'), []
+            )
+            order_date = self._parse_dates(df['order_date'], date_formats).dt.strftime('%Y-%m-%d')
             # Replace 'NaT' strings with None for proper NULL handling in BigQuery
-            df['order_date'] = df['order_date'].replace('NaT', None)
+            df = df.assign(order_date=order_date.replace('NaT', None))
             fixes.append("Standardized date formats to YYYY-MM-DD")
             logging.info("✓ Dates standardized")
         
         # 3. Handle Outliers and Nulls in amount column
         if 'amount' in df.columns:
-            df['amount'] = pd.to_numeric(df['amount'], errors='coerce')
-            outliers_before = (df['amount'] > 10000).sum()
-            
-            # Cap outliers at 1000
-            df.loc[df['amount'] > 10000, 'amount'] = 1000
-            
-            # Fill null amounts with 0 (AFTER deduplication)
-            null_amounts_filled = df['amount'].isnull().sum()
-            df['amount'] = df['amount'].fillna(0)
+            # Cap outliers at 1000 and fill null amounts with 0 (AFTER deduplication)
+            # in one fused pass over the raw float64 buffer
+            amounts = df['amount'].to_numpy(dtype=np.float64, copy=True)
+            outliers_before, null_amounts_filled = cap_and_count(amounts, 10000.0, 1000.0)
+            df['amount'] = amounts
             
             fixes.append(f"Capped {outliers_before} outliers (>10000 → 1000)")
             fixes.append(f"Filled {null_amounts_filled} null amounts with 0")
             logging.info(f"✓ Outliers capped, {null_amounts_filled} nulls filled")
         
-        # 4. Handle remaining nulls in other columns
-        null_summary = df.isnull().sum()
-        for col in null_summary[null_summary > 0].index:
-            if col != 'amount':  # Already handled
-                # Fill string columns with 'Unknown'
-                if df[col].dtype == 'object':
-                    df[col] = df[col].fillna('Unknown')
-                    fixes.append(f"Filled nulls in {col} with 'Unknown'")
+        # 4. Handle remaining nulls in other columns (amount is numeric, already handled)
+        # Fill string columns with 'Unknown': one null mask across all object columns,
+        # then a single where() over the columns that actually have nulls
+        obj_cols = df.columns[df.dtypes.eq(object)]
+        obj_nulls = df[obj_cols].isna()
+        null_cols = obj_cols[obj_nulls.any().to_numpy()]
+        if len(null_cols):
+            filled = df[null_cols].where(~obj_nulls[null_cols], 'Unknown')
+            # Shallow copy: the assignment swaps in new columns, so no data needs copying and
+            # the caller's frame is still left untouched (works for non-string labels too)
+            df = df.copy(deep=False)
+            df[null_cols] = filled
+            fixes.extend(f"Filled nulls in {col} with 'Unknown'" for col in null_cols)
         
         rows_out = len(df)
         rows_removed = rows_in - rows_out
@@ -440,12 +976,40 @@ class LoaderAgent(BaseAgent):
     
     def __init__(self, project_id: str, dataset_id: str, location: str = "us-central1"):
         super().__init__(project_id, location)
-        self.bq_client = bigquery.Client(project=project_id)
+        self.bq_client = _bigquery_client(project_id)
         self.dataset_id = dataset_id
         self.table_id = f"{project_id}.{dataset_id}.sales_data"
+        self._table_fields: Optional[Dict[str, Any]] = None  # destination column -> SchemaField
     
-    def execute(self, df: pd.DataFrame, metadata: Dict = None) -> Dict[str, Any]:
-        """Execute loading with validation"""
+    @staticmethod
+    def _bq_type(dtype) -> str:
+        """Map a pandas dtype to the BigQuery type its Parquet encoding loads as"""
+        if pd.api.types.is_bool_dtype(dtype):
+            return "BOOL"
+        if pd.api.types.is_integer_dtype(dtype):
+            return "INT64"
+        if pd.api.types.is_float_dtype(dtype):
+            return "FLOAT64"
+        if pd.api.types.is_datetime64_any_dtype(dtype):
+            return "TIMESTAMP"
+        return "STRING"
+    
+    def _destination_fields(self) -> Dict[str, Any]:
+        """Schema fields of the destination table by column, fetched once ({} until it exists)"""
+        if self._table_fields is None:
+            try:
+                table = self.bq_client.get_table(self.table_id)
+            except NotFound:
+                return {}
+            self._table_fields = {field.name: field for field in table.schema}
+        return self._table_fields
+    
+    def execute(self, df: pd.DataFrame, metadata: Dict = None,
+                null_counts: Optional[np.ndarray] = None) -> Dict[str, Any]:
+        """
+        Execute loading with validation
+        null_counts: per-column null counts from QualityAgent.profile(), valid only if df is unchanged since
+        """
         logging.info(f"🤖 Loader Agent: Validating and loading {len(df)} rows...")
         
         # Simple validation checks
@@ -459,15 +1023,28 @@ class LoaderAgent(BaseAgent):
             }
         
         # Check for basic data integrity
-        if df.isnull().all().any():
+        if null_counts is None:
+            null_counts = df.isnull().values.sum(axis=0)
+        if (null_counts == len(df)).any():
             logging.warning("⚠️  Some columns are entirely null")
         
         # Proceed with loading
         try:
+            # Declare the schema so BigQuery skips autodetection: existing columns keep the
+            # destination table's types (whole-number amounts must still load as FLOAT),
+            # only new columns are typed from their dtypes
+            table_fields = self._destination_fields()
+            fields = {
+                col: table_fields.get(col) or bigquery.SchemaField(col, self._bq_type(dtype))
+                for col, dtype in df.dtypes.items()
+            }
+            schema = list(fields.values())
+            
             # Configure load job with schema flexibility
             job_config = bigquery.LoadJobConfig(
                 write_disposition="WRITE_APPEND",
-                autodetect=True,
+                schema=schema,
+                autodetect=False,
                 schema_update_options=[
                     bigquery.SchemaUpdateOption.ALLOW_FIELD_ADDITION,
                     bigquery.SchemaUpdateOption.ALLOW_FIELD_RELAXATION
@@ -478,9 +1055,11 @@ class LoaderAgent(BaseAgent):
             job = self.bq_client.load_table_from_dataframe(
                 df, 
                 self.table_id, 
-                job_config=job_config
+                job_config=job_config,
+                parquet_compression="SNAPPY"
             )
             job.result()  # Wait for completion
+            self._table_fields = {**table_fields, **fields}  # the table now has any new columns too
             
             logging.info(f"✅ Successfully loaded {len(df)} rows to {self.table_id}")
             
@@ -8,12 +8,6 @@ import os
 from agents_adk import IngestionAgent, QualityAgent, TransformAgent, LoaderAgent
 from orchestrator_adk import PipelineManager
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-
 # ============================================================================
 # GCP CONFIGURATION
 # ============================================================================
@@ -29,7 +23,40 @@ LOCATION = "us-central1"  # Vertex AI location
 # Set to False to use rule-based routing (more reliable, follows strict thresholds)
 USE_LLM_ROUTING = False  # Recommended: False for reliability
 
-print("""
+# Set to a file path (e.g. "routing_cache") to persist LLM routing decisions across runs
+ROUTING_CACHE_PATH = None
+
+# Set to a JSON path (e.g. "routing_table.json") to learn a (score bucket, issue types) -> decision
+# table from LLM routing decisions, so recurring patterns skip Gemini on later runs
+ROUTING_TABLE_PATH = None
+
+# Set to a GCS prefix (e.g. f"gs://{BUCKET_NAME}/routing_batches") to send LLM routing
+# decisions as one Vertex AI batch prediction job (cheaper, but waits minutes for the job)
+BATCH_PREDICTION_URI = None
+
+# Max files worked on concurrently within a pipeline stage (GCS / Gemini / BigQuery calls are I/O-bound)
+MAX_WORKERS = 8
+
+# Worker processes for the CPU-bound quality / cleaning stages (e.g. os.cpu_count()); 0 = threads only
+CPU_WORKERS = 0
+
+# Set to True to pretty-print every pipeline stage (otherwise one structured log record per run)
+VERBOSE = False
+
+# Set to True to open the Gemini connection in the background at startup
+WARM_UP_GEMINI = False
+
+def main():
+    """Main execution function"""
+    
+    # Configure logging and print the banner here rather than at import time: the CPU
+    # worker forkserver re-imports this module as __mp_main__
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    
+    print("""
 ╔════════════════════════════════════════════════════════════════════╗
 ║                                                                    ║
 ║     🤖 AUTONOMOUS DATA PIPELINE - GOOGLE ADK                       ║
@@ -37,10 +64,7 @@ print("""
 ║     Powered by: Vertex AI Reasoning Engine + Gemini                ║
 ║                                                                    ║
 ╚════════════════════════════════════════════════════════════════════╝
-""")
-
-def main():
-    """Main execution function"""
+    """)
     
     print(f"\n🔧 Initializing Agents with Vertex AI...")
     print(f"   Project: {PROJECT_ID}")
@@ -88,7 +112,13 @@ def main():
         transform=transform,
         loader=loader,
         project_id=PROJECT_ID,
-        location=LOCATION
+        location=LOCATION,
+        max_workers=MAX_WORKERS,
+        routing_cache_path=ROUTING_CACHE_PATH,
+        routing_table_path=ROUTING_TABLE_PATH,
+        batch_prediction_uri=BATCH_PREDICTION_URI,
+        warm_up=WARM_UP_GEMINI,
+        cpu_workers=CPU_WORKERS
     )
     print("  ✓ Pipeline Manager (Gemini orchestration)")
     
@@ -106,25 +136,26 @@ def main():
     ]
     
     # ========================================
-    # Process Each File
+    # Process All Files (one batched Gemini call per stage)
     # ========================================
     results = []
     
     routing_mode = "LLM-powered (intelligent)" if USE_LLM_ROUTING else "Rule-based (reliable)"
     print(f"⚙️  Routing Mode: {routing_mode}\n")
     
-    for file_name in files:
-        try:
-            result = manager.process_file(file_name, use_llm_routing=USE_LLM_ROUTING)
-            results.append(result)
-            
-        except Exception as e:
-            logging.error(f"❌ Pipeline execution failed for {file_name}: {e}")
-            results.append({
-                "file": file_name,
-                "status": "FAILED",
-                "error": str(e)
-            })
+    try:
+        results = manager.process_files(files, use_llm_routing=USE_LLM_ROUTING, verbose=VERBOSE)
+        
+    except Exception as e:
+        logging.error(f"❌ Pipeline execution failed: {e}")
+        results = [{
+            "file": file_name,
+            "status": "FAILED",
+            "error": str(e)
+        } for file_name in files]
+    
+    finally:
+        manager.close()
     
     # ========================================
     # Summary Report
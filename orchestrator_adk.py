@@ -5,10 +5,48 @@ Coordinates multi-agent workflow with intelligent decision-making
 
 import time
 import logging
+import multiprocessing
 import json
-from typing import Dict, Any
-import vertexai
-from vertexai.generative_models import GenerativeModel
+import hashlib
+import io
+import os
+import random
+import re
+import reprlib
+import shelve
+import socket
+import sys
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Any, List, Callable, Optional, Tuple
+from google.api_core import exceptions as gcp_exceptions
+from vertexai.generative_models import GenerationConfig
+from agents_adk import init_vertexai, gemini_model, to_json
+
+# Failures worth retrying without asking Gemini (network blips, throttling, overload)
+TRANSIENT_ERRORS = (
+    ConnectionError,
+    TimeoutError,
+    socket.timeout,
+    gcp_exceptions.ServiceUnavailable,
+    gcp_exceptions.DeadlineExceeded,
+    gcp_exceptions.TooManyRequests,
+)
+
+# Failures no retry will fix (bad data, bad credentials)
+PERMANENT_ERRORS = (
+    ValueError,
+    KeyError,
+    PermissionError,
+    gcp_exceptions.Unauthenticated,
+    gcp_exceptions.PermissionDenied,
+    BrokenProcessPool,  # a CPU worker died; the pool rejects all further work (see safe_run)
+)
+
+# "Decision: CLEAN", "### **DECISION: ABORT", "**Decision:** PROCEED", ...
+_DECISION_RE = re.compile(r'DECISION:\s*\**\s*(PROCEED|CLEAN|ABORT)', re.IGNORECASE)
 
 
 class PipelineManager:
@@ -17,304 +55,950 @@ class PipelineManager:
     Uses Gemini to make intelligent routing and retry decisions
     """
     
-    def __init__(self, ingestion, quality, transform, loader, project_id: str, location: str = "us-central1"):
+    # Scores close to a rule threshold (60 / 80), where Gemini's judgment is worth a call
+    LLM_ROUTING_BANDS = ((55, 65), (78, 82))
+    # Issue types that get Gemini's judgment anywhere between the bands (issues flagged
+    # severity 'critical' always do); empty so routine messy files stay rule-based
+    CRITICAL_ISSUE_TYPES = frozenset()
+    
+    # Structured-output schemas: the answer is a single enum value plus a short reason
+    RETRY_SCHEMA = {
+        "type": "object",
+        "properties": {
+            "action": {"type": "string", "enum": ["RETRY", "ABORT"]},
+            "reason": {"type": "string"}
+        },
+        "required": ["action"]
+    }
+    ROUTING_SCHEMA = {
+        "type": "object",
+        "properties": {
+            "decision": {"type": "string", "enum": ["PROCEED", "CLEAN", "ABORT"]},
+            "reason": {"type": "string"}
+        },
+        "required": ["decision"]
+    }
+    
+    # Static instructions live in the judge models' system instructions, so every call
+    # shares the same prefix and only the per-case details below are sent each time
+    _RETRY_INSTRUCTION = """
+You judge failed data-pipeline agent calls: should the pipeline retry or abort?
+
+Consider:
+1. Is this a transient error (network, timeout) or permanent (invalid data, auth)?
+2. Will retrying likely succeed?
+3. What's the risk of retry vs abort?
+
+Answer with the action (RETRY or ABORT) and a brief reason.
+"""
+    
+    _RETRY_TEMPLATE = """
+Agent: {agent_name}
+Attempt: {attempt}/{attempts}
+Error: {error}
+Error Type: {error_type}
+Arguments: {args}
+"""
+    
+    _ROUTING_INSTRUCTION = """
+You route data files through a data pipeline based on their quality assessment.
+
+Standard Rules:
+- Score < 60: ABORT pipeline
+- Score 60-80: CLEAN data and proceed
+- Score > 80: PROCEED directly (skip cleaning)
+
+Your task: Analyze each case and decide: ABORT, CLEAN, or PROCEED.
+Consider the types of issues, their severity, and business impact.
+
+Answer as JSON: {"decision": "ABORT" | "CLEAN" | "PROCEED", "reason": "<brief reason>"}
+"""
+    
+    _ROUTING_TEMPLATE = """
+Quality Score: {quality_score}/100
+Issues Detected:
+{issues}
+"""
+    
+    def __init__(self, ingestion, quality, transform, loader, project_id: str, location: str = "us-central1",
+                 max_workers: int = 8, routing_cache_path: Optional[str] = None,
+                 routing_table_path: Optional[str] = None,
+                 batch_prediction_uri: Optional[str] = None, batch_poll_seconds: int = 30,
+                 batch_timeout_seconds: int = 1800, warm_up: bool = False, cpu_workers: int = 0):
         self.ingestion = ingestion
         self.quality = quality
         self.transform = transform
         self.loader = loader
+        self.max_workers = max_workers
+        
+        # Worker processes for the CPU-bound pandas stages (quality checks, cleaning), so
+        # several files are crunched in parallel past the GIL; 0 keeps them on threads.
+        # Workers come from a forkserver: forking this process after its gRPC channels
+        # and worker threads exist is unsafe
+        self.cpu_workers = cpu_workers
+        self._cpu_pool_lock = threading.Lock()
+        self._cpu_pool = self._new_cpu_pool() if cpu_workers else None
+        
+        # BigQuery loads run in the background, starting as soon as each file's data is final
+        # (PROCEED files right after routing), overlapping with the cleaning of other files
+        self._loader_pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="loader")
+        
+        # gs:// prefix for Vertex AI batch prediction of LLM routing decisions (None = online calls)
+        self.batch_prediction_uri = batch_prediction_uri.rstrip('/') if batch_prediction_uri else None
+        self.batch_poll_seconds = batch_poll_seconds
+        self.batch_timeout_seconds = batch_timeout_seconds  # give up and route online after this
+        
+        # Memoized LLM routing decisions keyed by (score, issue signature);
+        # persisted with shelve across runs when a path is given
+        self._routing_cache = shelve.open(routing_cache_path) if routing_cache_path else {}
+        
+        # Learned routing table: (score // 5, issue types) -> decision, filled from LLM decisions
+        # and persisted as JSON, so recurring patterns are a dict lookup (None = disabled)
+        self.routing_table_path = routing_table_path
+        self._routing_table = self._load_routing_table(routing_table_path) if routing_table_path else None
+        self._routing_table_dirty = False
+        
+        # Structured per-stage outcomes of the latest run (see process_files)
+        self._stage_log: List[Dict[str, Any]] = []
         
         # Initialize Gemini for orchestration decisions
-        vertexai.init(project=project_id, location=location)
+        init_vertexai(project_id, location)
         # Use gemini-pro which is widely available
-        self.orchestrator_llm = GenerativeModel("gemini-2.5-flash")
+        self.orchestrator_llm = gemini_model("gemini-2.5-flash", self._ROUTING_INSTRUCTION)
+        self._retry_llm = gemini_model("gemini-2.5-flash", self._RETRY_INSTRUCTION)
+        self._retry_config = GenerationConfig(
+            response_mime_type="application/json",
+            response_schema=self.RETRY_SCHEMA
+        )
+        self._routing_config = GenerationConfig(
+            response_mime_type="application/json",
+            response_schema=self.ROUTING_SCHEMA
+        )
+        
+        # Open the gRPC channel and fetch the auth token in the background,
+        # so the first real decision doesn't pay for the handshake
+        if warm_up:
+            threading.Thread(target=self._warm_up, name="gemini-warmup", daemon=True).start()
         
         logging.info("🚀 Pipeline Manager initialized with Gemini orchestration")
     
-    def safe_run(self, agent_func, *args, retries=2, agent_name="Agent"):
+    def _new_cpu_pool(self) -> ProcessPoolExecutor:
+        """Start a process pool of cpu_workers forkserver workers"""
+        return ProcessPoolExecutor(
+            max_workers=self.cpu_workers,
+            mp_context=multiprocessing.get_context("forkserver")
+        )
+    
+    def _replace_cpu_pool(self, broken: ProcessPoolExecutor):
+        """Swap a pool whose worker died for a fresh one (once, however many calls saw it break)"""
+        with self._cpu_pool_lock:
+            if self._cpu_pool is broken:
+                logging.warning("⚠️  CPU worker process died, starting a new pool")
+                broken.shutdown(wait=False)
+                self._cpu_pool = self._new_cpu_pool()
+    
+    def close(self):
+        """Shut down the worker pools (waiting for in-flight work) and close the routing cache"""
+        if self._cpu_pool is not None:
+            self._cpu_pool.shutdown()
+        self._loader_pool.shutdown()
+        if isinstance(self._routing_cache, shelve.Shelf):
+            self._routing_cache.close()  # writes back and closes the dbm file
+    
+    def _warm_up(self):
+        """Send a one-token request to establish the Gemini connection"""
+        try:
+            self.orchestrator_llm.generate_content(
+                "ping",
+                generation_config=GenerationConfig(max_output_tokens=1)
+            )
+            logging.info("🔥 Gemini connection warmed up")
+        except Exception as e:
+            logging.warning("⚠️  Gemini warm-up failed (first call will connect instead): %s", e)
+    
+    def safe_run(self, agent_func, *args, retries=2, agent_name="Agent", pool=None):
         """
         Execute agent with retry logic and LLM-powered failure analysis
+        pool: optional executor to run agent_func in (e.g. the CPU process pool)
         """
         for i in range(retries + 1):
             try:
+                if pool is not None:
+                    return pool.submit(agent_func, *args).result()
                 result = agent_func(*args)
                 return result
                 
             except Exception as e:
-                error_context = f"""
-Agent: {agent_name}
-Attempt: {i+1}/{retries+1}
-Error: {str(e)}
-Error Type: {type(e).__name__}
-Arguments: {args}
-"""
-                
+                if isinstance(e, BrokenProcessPool) and pool is not None:
+                    self._replace_cpu_pool(pool)  # later calls get a working pool
                 if i < retries:
-                    # Ask Gemini if retry makes sense
-                    retry_question = f"""
-An agent failed with the following error. Should we retry or abort?
-
-{error_context}
-
-Consider:
-1. Is this a transient error (network, timeout) or permanent (invalid data, auth)?
-2. Will retrying likely succeed?
-3. What's the risk of retry vs abort?
-
-Respond with: RETRY or ABORT, followed by brief reasoning.
-"""
-                    
-                    retry_decision = self.orchestrator_llm.generate_content(retry_question).text
-                    logging.warning(f"🧠 Gemini retry analysis: {retry_decision}")
-                    
-                    if "ABORT" in retry_decision.upper():
-                        logging.error(f"❌ Gemini recommends aborting after failure")
+                    if isinstance(e, TRANSIENT_ERRORS):
+                        logging.warning("🔁 Transient %s in %s, retrying without Gemini analysis", type(e).__name__, agent_name)
+                    elif isinstance(e, PERMANENT_ERRORS):
+                        logging.error("❌ Permanent %s in %s, not retrying", type(e).__name__, agent_name)
                         raise
+                    else:
+                        # Ambiguous failure: ask Gemini if retry makes sense
+                        retry_question = self._RETRY_TEMPLATE.format(
+                            agent_name=agent_name,
+                            attempt=i + 1,
+                            attempts=retries + 1,
+                            error=e,
+                            error_type=type(e).__name__,
+                            args=reprlib.repr(args)  # DataFrame args would otherwise dump whole tables
+                        )
+                        response = self._retry_llm.generate_content(
+                            retry_question,
+                            generation_config=self._retry_config
+                        )
+                        try:
+                            retry_decision = json.loads(response.text)
+                        except ValueError:
+                            retry_decision = {}  # unreadable answer: keep retrying
+                        logging.warning("🧠 Gemini retry analysis: %s - %s", retry_decision.get('action'), retry_decision.get('reason', ''))
+                        
+                        if retry_decision.get('action') == "ABORT":
+                            logging.error("❌ Gemini recommends aborting after failure")
+                            raise
                     
-                    logging.warning(f"⚠️  Retry {i+1}/{retries} after error: {e}")
-                    time.sleep(1)
+                    delay = self._backoff_delay(i, e)
+                    logging.warning("⚠️  Retry %d/%d in %.1fs after error: %s", i + 1, retries, delay, e)
+                    time.sleep(delay)
                 else:
-                    logging.error(f"❌ Final failure in {agent_name}. Alerting Admin.")
+                    logging.error("❌ Final failure in %s. Alerting Admin.", agent_name)
                     raise
     
+    @staticmethod
+    def _backoff_delay(attempt: int, error: Exception, cap: float = 30.0) -> float:
+        """
+        Truncated exponential backoff with jitter, so parallel workers don't retry in lockstep
+        A Retry-After header on the error's HTTP response takes precedence (still capped)
+        """
+        headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+        retry_after = headers.get('Retry-After')
+        if retry_after is not None:
+            try:
+                return min(cap, float(retry_after))
+            except (TypeError, ValueError):
+                pass  # HTTP-date form; use the computed backoff instead
+        
+        return min(cap, random.uniform(0.5, 1.0) * (2 ** attempt))
+    
+    def _map_files(self, func: Callable[[str], Any], file_names: List[str]) -> Dict[str, Tuple[Any, Optional[Exception]]]:
+        """
+        Run func(file_name) for each file on a thread pool (per-file work is dominated by
+        GCS / Gemini / BigQuery calls, which release the GIL)
+        Returns {file_name: (result, error)} so callers can report in their own order
+        """
+        outcomes = {}
+        if not file_names:
+            return outcomes
+        
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(file_names)))) as executor:
+            futures = {executor.submit(func, file_name): file_name for file_name in file_names}
+            for future in as_completed(futures):
+                file_name = futures[future]
+                try:
+                    outcomes[file_name] = (future.result(), None)
+                except Exception as e:
+                    outcomes[file_name] = (None, e)
+        
+        return outcomes
+    
+    @staticmethod
+    def _routing_key(quality_score: int, issues: list) -> str:
+        """
+        Stable cache key for a routing decision: the score plus a canonical issue signature
+        of (type, column, count // 10), so near-identical issue sets share an entry
+        """
+        signature = tuple(sorted(
+            (issue.get('type', ''), str(issue.get('column', '')), issue.get('count', 0) // 10)
+            for issue in issues
+        ))
+        return hashlib.blake2b(repr((quality_score, signature)).encode(), digest_size=16).hexdigest()
+    
+    @staticmethod
+    def _routing_table_key(quality_score: int, issues: list) -> str:
+        """
+        Coarse routing-table key: 5-point score bucket plus the set of issue types
+        (a JSON-friendly string, e.g. "14:duplicate_orders,nulls")
+        """
+        kinds = sorted({issue.get('type', '') for issue in issues})
+        return f"{quality_score // 5}:{','.join(kinds)}"
+    
+    @staticmethod
+    def _load_routing_table(path: str) -> Dict[str, str]:
+        """Load a persisted routing table; a missing or unreadable file starts an empty one"""
+        try:
+            with open(path) as fh:
+                return json.load(fh)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logging.warning("⚠️  Ignoring unreadable routing table %s: %s", path, e)
+            return {}
+    
+    def _save_routing_table(self):
+        """Persist the routing table if it learned anything this run (atomic replace)"""
+        if self._routing_table is None or not self._routing_table_dirty:
+            return
+        tmp_path = f"{self.routing_table_path}.tmp"
+        with open(tmp_path, "w") as fh:
+            json.dump(self._routing_table, fh, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.routing_table_path)
+        self._routing_table_dirty = False
+        logging.info("💾 Saved %d routing table entries to %s", len(self._routing_table), self.routing_table_path)
+    
+    def _learned_decision(self, quality_score: int, issues: list) -> Tuple[Optional[str], str]:
+        """
+        Look up a previously learned decision: the routing table first, then the exact cache
+        Returns (decision or None, exact cache key)
+        """
+        cache_key = self._routing_key(quality_score, issues)
+        if self._routing_table is not None:
+            decision = self._routing_table.get(self._routing_table_key(quality_score, issues))
+            if decision is not None:
+                return decision, cache_key
+        return self._routing_cache.get(cache_key), cache_key
+    
+    def _remember_decision(self, quality_score: int, issues: list, cache_key: str, decision: str):
+        """Record a parsed LLM decision in the exact cache and, if enabled, the routing table"""
+        self._routing_cache[cache_key] = decision
+        if self._routing_table is not None:
+            self._routing_table.setdefault(self._routing_table_key(quality_score, issues), decision)
+            self._routing_table_dirty = True
+    
     def make_routing_decision(self, quality_score: int, issues: list, use_llm: bool = True) -> str:
         """
         Use Gemini to make intelligent pipeline routing decisions
         Can fall back to rule-based logic if use_llm=False
         """
-        # For very clear cases, use rule-based logic directly
-        if not use_llm or (quality_score == 100 and len(issues) == 0):
-            if quality_score < 60:
-                logging.info(f"📊 Rule-based decision: ABORT (score {quality_score} < 60)")
-                return "ABORT"
-            elif 60 <= quality_score <= 80:
-                logging.info(f"📊 Rule-based decision: CLEAN (score {quality_score} in 60-80)")
-                return "CLEAN"
-            else:
-                logging.info(f"📊 Rule-based decision: PROCEED (score {quality_score} > 80)")
-                return "PROCEED"
+        # For clear cases away from the thresholds, use rule-based logic directly
+        if not use_llm or not self._needs_llm(quality_score, issues):
+            return self._rule_based_decision(quality_score, "Rule-based decision:")
         
-        # Use LLM for nuanced decisions
-        decision_context = f"""
-Quality Score: {quality_score}/100
-Issues Detected: {json.dumps(issues, indent=2)}
-
-Standard Rules:
-- Score < 60: ABORT pipeline
-- Score 60-80: CLEAN data and proceed
-- Score > 80: PROCEED directly (skip cleaning)
-
-Your task: Analyze this specific case and decide: ABORT, CLEAN, or PROCEED.
-Consider the types of issues, their severity, and business impact.
-
-IMPORTANT: Start your response with "Decision: [ABORT|CLEAN|PROCEED]" on the first line.
-"""
+        # Reuse an earlier LLM decision for the same score and issue pattern
+        cached, cache_key = self._learned_decision(quality_score, issues)
+        if cached is not None:
+            logging.info("💾 Cached routing decision: %s", cached)
+            return cached
         
-        response = self.orchestrator_llm.generate_content(decision_context)
+        # Use LLM for nuanced decisions
+        response = self.orchestrator_llm.generate_content(
+            self._routing_prompt(quality_score, issues),
+            generation_config=self._routing_config
+        )
         decision_text = response.text
         
-        logging.info(f"🧠 Gemini routing decision: {decision_text[:200]}")
+        logging.info("🧠 Gemini routing decision: %.200s", decision_text)
         
-        # Enhanced parsing logic - check first 3 lines for clear decision
-        first_lines = decision_text[:500].upper()
-        
-        # Priority-based parsing: Look for explicit decision markers first
-        if "DECISION: PROCEED" in first_lines or "### **DECISION: PROCEED" in first_lines:
-            return "PROCEED"
-        elif "DECISION: CLEAN" in first_lines or "### **DECISION: CLEAN" in first_lines:
-            return "CLEAN"
-        elif "DECISION: ABORT" in first_lines or "### **DECISION: ABORT" in first_lines:
-            return "ABORT"
+        decision = self._parse_decision(decision_text)
+        if decision is not None:
+            self._remember_decision(quality_score, issues, cache_key, decision)
+            return decision
         
         # Fallback: Use rule-based logic with quality score
+        return self._rule_based_decision(quality_score, "Fallback: Using rule-based")
+    
+    def _needs_llm(self, quality_score: int, issues: list) -> bool:
+        """
+        Only ambiguous cases go to Gemini: a score in one of the uncertainty bands, or a
+        critical issue (severity or CRITICAL_ISSUE_TYPES) on a score between them. Everything
+        else follows the rules.
+        """
+        if any(low <= quality_score <= high for low, high in self.LLM_ROUTING_BANDS):
+            return True
+        
+        lowest, highest = self.LLM_ROUTING_BANDS[0][0], self.LLM_ROUTING_BANDS[-1][1]
+        return lowest <= quality_score <= highest and any(
+            issue.get('type') in self.CRITICAL_ISSUE_TYPES or issue.get('severity') == 'critical'
+            for issue in issues
+        )
+    
+    @staticmethod
+    def _rule_based_decision(quality_score: int, label: str) -> str:
+        """
+        Standard thresholds: < 60 ABORT, 60-80 CLEAN, > 80 PROCEED
+        """
         if quality_score < 60:
-            logging.info(f"📊 Fallback: Using rule-based ABORT (score {quality_score} < 60)")
+            logging.info("📊 %s ABORT (score %d < 60)", label, quality_score)
             return "ABORT"
         elif 60 <= quality_score <= 80:
-            logging.info(f"📊 Fallback: Using rule-based CLEAN (score {quality_score} in 60-80)")
+            logging.info("📊 %s CLEAN (score %d in 60-80)", label, quality_score)
             return "CLEAN"
         else:
-            logging.info(f"📊 Fallback: Using rule-based PROCEED (score {quality_score} > 80)")
+            logging.info("📊 %s PROCEED (score %d > 80)", label, quality_score)
             return "PROCEED"
     
-    def process_file(self, file_name: str, use_llm_routing: bool = False) -> Dict[str, Any]:
+    @classmethod
+    def _routing_prompt(cls, quality_score: int, issues: list) -> str:
+        """
+        Build the Gemini routing prompt for one file
+        """
+        return cls._ROUTING_TEMPLATE.format(quality_score=quality_score, issues=cls._issue_lines(issues))
+    
+    @staticmethod
+    def _issue_lines(issues: list, limit: int = 10) -> str:
+        """
+        Compact prompt view of the issues: one "- type[column] xcount" line each,
+        largest counts first, capped at limit
+        """
+        top = sorted(issues, key=lambda issue: -issue.get('count', 0))[:limit]
+        lines = [f"- {issue['type']}[{issue.get('column', '')}] x{issue.get('count', 0)}" for issue in top]
+        if len(issues) > limit:
+            lines.append(f"- ... {len(issues) - limit} more")
+        return "\n".join(lines) if lines else "none"
+    
+    @staticmethod
+    def _parse_decision(decision_text: str) -> Optional[str]:
+        """
+        Read the decision from a structured {"decision": ...} answer, falling back to an
+        explicit "Decision: X" marker in free text
+        Returns None when the answer has no clear decision
+        """
+        try:
+            decision = json.loads(decision_text).get('decision')
+        except (ValueError, AttributeError):
+            decision = None
+        if decision in ("PROCEED", "CLEAN", "ABORT"):
+            return decision
+        
+        # Only the opening of the answer counts - later text may discuss the alternatives
+        match = _DECISION_RE.search(decision_text, 0, 500)
+        return match.group(1).upper() if match else None
+    
+    def make_routing_decisions_batch(self, cases: Dict[str, Tuple[int, list]]) -> Dict[str, str]:
+        """
+        Route many files with a single Vertex AI batch prediction job instead of one online
+        Gemini call each (batch jobs are billed at a discount; this pipeline is offline and
+        can wait). Clear-cut and cached cases never reach the job.
+        
+        Args:
+            cases: {file_name: (quality_score, issues)}
+        
+        Returns:
+            {file_name: decision}
+        """
+        decisions = {}
+        pending = {}  # prompt -> [(file_name, quality_score, issues, cache_key)]
+        
+        for file_name, (quality_score, issues) in cases.items():
+            if not self._needs_llm(quality_score, issues):
+                decisions[file_name] = self._rule_based_decision(quality_score, "Rule-based decision:")
+                continue
+            
+            cached, cache_key = self._learned_decision(quality_score, issues)
+            if cached is not None:
+                logging.info("💾 Cached routing decision for %s: %s", file_name, cached)
+                decisions[file_name] = cached
+                continue
+            
+            prompt = self._routing_prompt(quality_score, issues)
+            pending.setdefault(prompt, []).append((file_name, quality_score, issues, cache_key))
+        
+        if not pending:
+            return decisions
+        
+        answers = self._run_batch_prediction(list(pending))
+        
+        for prompt, waiting in pending.items():
+            decision_text = answers.get(prompt, "")
+            decision = self._parse_decision(decision_text)
+            for file_name, quality_score, issues, cache_key in waiting:
+                logging.info("🧠 Gemini batch routing decision for %s: %.200s", file_name, decision_text)
+                if decision is not None:
+                    self._remember_decision(quality_score, issues, cache_key, decision)
+                    decisions[file_name] = decision
+                else:
+                    decisions[file_name] = self._rule_based_decision(quality_score, "Fallback: Using rule-based")
+        
+        return decisions
+    
+    def _run_batch_prediction(self, prompts: List[str]) -> Dict[str, str]:
+        """
+        Submit prompts as one Gemini batch prediction job and wait for it
+        Input/output JSONL lives under batch_prediction_uri; returns {prompt: answer text}
+        """
+        from vertexai.batch_prediction import BatchPredictionJob
+        
+        # 1. Write the request JSONL to GCS
+        bucket_name, _, prefix = self.batch_prediction_uri[len("gs://"):].partition("/")
+        run_prefix = "/".join(filter(None, [prefix, time.strftime("routing-%Y%m%d-%H%M%S-") + uuid.uuid4().hex[:8]]))
+        lines = [
+            to_json({"request": {
+                "systemInstruction": {"parts": [{"text": self._ROUTING_INSTRUCTION}]},
+                "contents": [{"role": "user", "parts": [{"text": prompt}]}],
+                "generationConfig": {"responseMimeType": "application/json"}
+            }})
+            for prompt in prompts
+        ]
+        storage_client = self.ingestion.storage_client
+        storage_client.bucket(bucket_name).blob(f"{run_prefix}/input.jsonl").upload_from_string(
+            "\n".join(lines), content_type="application/jsonl"
+        )
+        
+        # 2. Submit and poll until the job ends or the deadline passes
+        job = BatchPredictionJob.submit(
+            source_model="gemini-2.5-flash",
+            input_dataset=f"gs://{bucket_name}/{run_prefix}/input.jsonl",
+            output_uri_prefix=f"gs://{bucket_name}/{run_prefix}/output"
+        )
+        logging.info("📦 Submitted batch routing job %s (%d prompts)", job.resource_name, len(prompts))
+        
+        deadline = time.monotonic() + self.batch_timeout_seconds
+        while not job.has_ended:
+            if time.monotonic() >= deadline:
+                try:
+                    job.cancel()
+                except Exception as e:
+                    logging.warning("⚠️  Could not cancel batch job %s: %s", job.resource_name, e)
+                raise TimeoutError(
+                    f"Batch prediction job {job.resource_name} still running after {self.batch_timeout_seconds}s"
+                )
+            time.sleep(self.batch_poll_seconds)
+            job.refresh()
+        
+        if not job.has_succeeded:
+            raise RuntimeError(f"Batch prediction job {job.resource_name} failed: {job.error}")
+        
+        # 3. Read predictions back; each line echoes its request, so match answers by prompt text
+        out_bucket, _, out_prefix = job.output_location[len("gs://"):].partition("/")
+        answers = {}
+        for blob in storage_client.list_blobs(out_bucket, prefix=out_prefix):
+            if not blob.name.endswith(".jsonl"):
+                continue
+            for line in blob.download_as_text().splitlines():
+                record = json.loads(line)
+                prompt = record["request"]["contents"][0]["parts"][0]["text"]
+                try:
+                    answers[prompt] = record["response"]["candidates"][0]["content"]["parts"][0]["text"]
+                except (KeyError, IndexError):
+                    logging.warning("⚠️  Batch prediction row failed: %s", record.get('status', 'no response'))
+        
+        logging.info("✅ Batch routing job finished: %d/%d answers", len(answers), len(prompts))
+        return answers
+    
+    def process_file(self, file_name: str, use_llm_routing: bool = False, verbose: bool = False) -> Dict[str, Any]:
         """
         Main pipeline orchestration with LLM-powered decision making
+        Single-file convenience wrapper around process_files()
         
         Args:
             file_name: Name of the file to process
             use_llm_routing: If True, use LLM for routing decisions. If False, use rule-based logic.
+            verbose: If True, pretty-print every stage to stdout (interactive debugging)
+        """
+        return self.process_files([file_name], use_llm_routing=use_llm_routing, verbose=verbose)[0]
+    
+    def process_files(self, file_names: List[str], use_llm_routing: bool = False,
+                      verbose: bool = False) -> List[Dict[str, Any]]:
         """
-        print(f"\n{'='*70}")
-        print(f"🚀 AUTONOMOUS PIPELINE: {file_name}")
-        print(f"{'='*70}\n")
+        Batched pipeline orchestration: each stage runs across all files before the next,
+        so every Gemini-powered stage costs one batched round trip instead of one per file
         
-        try:
-            # ========================================
-            # STEP 1: INGESTION
-            # ========================================
-            print("📥 STEP 1: Ingestion Agent")
-            print("-" * 70)
-            
-            ingest_out = self.safe_run(
-                self.ingestion.execute, 
-                file_name,
-                agent_name="Ingestion Agent"
+        Stage outcomes are collected in self._stage_log and emitted as a single structured
+        log record at the end of the run
+        
+        Args:
+            file_names: Names of the files to process
+            use_llm_routing: If True, use LLM for routing decisions. If False, use rule-based logic.
+            verbose: If True, pretty-print every stage to stdout (interactive debugging)
+        
+        Returns:
+            One report per file, in the same order as file_names
+        """
+        # Verbose output is buffered and written once per stage instead of line by line;
+        # every say() group sits under `if verbose:` so nothing is formatted otherwise
+        stage_output = io.StringIO()
+        
+        def say(*args):
+            if verbose:
+                print(*args, file=stage_output)
+        
+        def flush_stage():
+            if verbose:
+                sys.stdout.write(stage_output.getvalue())
+                sys.stdout.flush()
+                stage_output.seek(0)
+                stage_output.truncate()
+        
+        self._stage_log = []
+        
+        if verbose:
+            say(f"\n{'='*70}")
+            say(f"🚀 AUTONOMOUS PIPELINE: {', '.join(file_names)}")
+            say(f"{'='*70}\n")
+        
+        results = {}  # file_name -> final report (SUCCESS / ABORTED / FAILED)
+        runs = {}     # file_name -> in-flight state for files still in the pipeline
+        
+        def fail(file_name: str, e: Exception):
+            logging.error("💥 Pipeline failed for %s: %s", file_name, e)
+            if verbose:
+                say(f"\n❌ PIPELINE FAILED ({file_name}): {e}\n")
+            self._stage_log.append({"stage": "failed", "file": file_name, "error": str(e)})
+            results[file_name] = {
+                "file": file_name,
+                "status": "FAILED",
+                "error": str(e)
+            }
+            runs.pop(file_name, None)
+        
+        def detect(data):
+            return self.safe_run(
+                self.quality.profile_and_detect,
+                data,
+                agent_name="Quality Agent",
+                pool=self._cpu_pool
+            )
+        
+        loading = {}  # file_name -> Future of its loader result
+        
+        def start_load(file_name: str):
+            run = runs[file_name]
+            # Quality-stage null counts still describe the data unless it was transformed
+            null_counts = run['profile']['null_counts'] if run['decision'] != "CLEAN" else None
+            loading[file_name] = self._loader_pool.submit(
+                self.safe_run,
+                self.loader.execute,
+                run['data'],
+                run['metadata'],
+                null_counts,
+                agent_name="Loader Agent"
             )
+        
+        # Rule-based quality checks start on this pool as soon as each file is ingested,
+        # overlapping with parsing of the files after it
+        profiler = ThreadPoolExecutor(max_workers=max(1, min(self.max_workers, len(file_names))))
+        detecting = {}
+        
+        # ========================================
+        # STEP 1: INGESTION
+        # ========================================
+        say("📥 STEP 1: Ingestion Agent")
+        say("-" * 70)
+        
+        # Fetch small blobs concurrently (up to the prefetch byte budget; larger files stream
+        # during parsing), then parse in order so schema tracking stays sequential
+        contents = self.ingestion.prefetch(file_names)
+        
+        for file_name in file_names:
+            try:
+                ingest_out = self.safe_run(
+                    self.ingestion.execute, 
+                    file_name,
+                    contents.pop(file_name, None),  # release the raw bytes once parsed
+                    agent_name="Ingestion Agent"
+                )
+            except Exception as e:
+                fail(file_name, e)
+                continue
             
-            data = ingest_out['data']
+            runs[file_name] = {
+                "data": ingest_out['data'],
+                "metadata": ingest_out['metadata']
+            }
+            detecting[file_name] = profiler.submit(detect, ingest_out['data'])
             metadata = ingest_out['metadata']
+            self._stage_log.append({
+                "stage": "ingestion",
+                "file": file_name,
+                "rows": metadata['rows'],
+                "format": metadata['format'],
+                "schema_changed": metadata['schema_changed'],
+                "new_columns": metadata['new_columns']
+            })
             
-            print(f"✅ Ingested {metadata['rows']} rows")
-            print(f"   Format: {metadata['format']}")
-            print(f"   Schema: {metadata['schema']}")
-            
-            if metadata['schema_changed']:
-                print(f"⚠️  SCHEMA CHANGE DETECTED!")
-                print(f"   New columns: {metadata['new_columns']}")
-                print(f"   LLM Analysis: {metadata['llm_analysis'][:150]}...")
-            
-            print()
-            
-            # ========================================
-            # STEP 2: QUALITY ASSESSMENT
-            # ========================================
-            print("🔍 STEP 2: Quality Agent")
-            print("-" * 70)
-            
-            quality_out = self.safe_run(
-                self.quality.execute,
-                data,
+            if verbose:
+                say(f"✅ [{file_name}] Ingested {metadata['rows']} rows")
+                say(f"   Format: {metadata['format']}")
+                say(f"   Schema: {metadata['schema']}")
+                
+                if metadata['schema_changed']:
+                    say(f"⚠️  SCHEMA CHANGE DETECTED!")
+                    say(f"   New columns: {metadata['new_columns']}")
+                    say(f"   LLM Analysis: {metadata['llm_analysis'][:150]}...")
+        
+        say()
+        flush_stage()
+        
+        # ========================================
+        # STEP 2: QUALITY ASSESSMENT
+        # ========================================
+        say("🔍 STEP 2: Quality Agent")
+        say("-" * 70)
+        
+        for file_name in list(runs):
+            try:
+                runs[file_name]['profile'], runs[file_name]['issues'] = detecting[file_name].result()
+            except Exception as e:
+                fail(file_name, e)
+        profiler.shutdown()
+        
+        # One Gemini round trip for every file's quality assessment
+        batch = list(runs)
+        try:
+            assessments = self.safe_run(
+                self.quality.reason_batch,
+                [self.quality.assessment_prompt(runs[f]['data'], runs[f]['issues'], runs[f]['metadata']) for f in batch],
+                self.quality.ASSESSMENT_SCHEMA,
+                self.quality.ASSESSMENT_MAX_TOKENS,
                 agent_name="Quality Agent"
             )
+        except Exception as e:
+            # The assessment is informational (the rule-based score decides), so carry on without it
+            logging.warning("⚠️  Quality assessment batch failed, continuing without it: %s", e)
+            assessments = [{} for _ in batch]
+        
+        for file_name, assessment in zip(batch, assessments):
+            run = runs[file_name]
+            try:
+                quality_out = self.safe_run(
+                    self.quality.execute,
+                    run['data'],
+                    run['issues'],
+                    assessment,
+                    run['profile'],
+                    agent_name="Quality Agent"
+                )
+            except Exception as e:
+                fail(file_name, e)
+                continue
             
-            score = quality_out['quality_score']
-            issues = quality_out['issues']
-            
-            print(f"📊 Quality Score: {score}/100")
-            print(f"   Issues found: {len(issues)}")
-            for issue in issues[:3]:  # Show first 3 issues
-                print(f"   - {issue['type']}: {issue.get('column', 'N/A')} ({issue.get('count', 0)} affected)")
-            
-            print()
+            run['score'] = quality_out['quality_score']
+            run['issues'] = quality_out['issues']
+            self._stage_log.append({
+                "stage": "quality",
+                "file": file_name,
+                "score": run['score'],
+                "issues": len(run['issues'])
+            })
             
-            # ========================================
-            # STEP 3: INTELLIGENT ROUTING DECISION
-            # ========================================
+            if verbose:
+                say(f"📊 [{file_name}] Quality Score: {run['score']}/100")
+                say(f"   Issues found: {len(run['issues'])}")
+                if quality_out['issue_preview']:  # First 3 issues
+                    say(quality_out['issue_preview'])
+        
+        say()
+        flush_stage()
+        
+        # ========================================
+        # STEP 3: INTELLIGENT ROUTING DECISION
+        # ========================================
+        if verbose:
             mode = "Rule-Based" if not use_llm_routing else "Gemini-Powered"
-            print(f"🤔 STEP 3: Routing Decision ({mode})")
-            print("-" * 70)
+            say(f"🤔 STEP 3: Routing Decision ({mode})")
+            say("-" * 70)
+        
+        # Offline mode: every LLM routing decision in one Vertex AI batch prediction job
+        batch_decisions = {}
+        if use_llm_routing and self.batch_prediction_uri:
+            try:
+                batch_decisions = self.make_routing_decisions_batch(
+                    {f: (runs[f]['score'], runs[f]['issues']) for f in runs}
+                )
+            except Exception as e:
+                logging.warning("⚠️  Batch routing failed, falling back to online calls: %s", e)
+        
+        for file_name in list(runs):
+            run = runs[file_name]
+            score = run['score']
             
-            decision = self.make_routing_decision(score, issues, use_llm=use_llm_routing)
+            try:
+                run['decision'] = batch_decisions.get(file_name) or self.make_routing_decision(
+                    score, run['issues'], use_llm=use_llm_routing
+                )
+            except Exception as e:
+                fail(file_name, e)
+                continue
             
-            print(f"🎯 Decision: {decision}")
+            self._stage_log.append({"stage": "routing", "file": file_name, "decision": run['decision']})
+            if verbose:
+                say(f"🎯 [{file_name}] Decision: {run['decision']}")
             
-            if decision == "ABORT":
-                print(f"❌ ABORTING: Quality score {score} too low")
-                print(f"   Recommendation: Fix data at source and resubmit")
-                return {
+            if run['decision'] == "ABORT":
+                if verbose:
+                    say(f"❌ ABORTING: Quality score {score} too low")
+                    say(f"   Recommendation: Fix data at source and resubmit")
+                results[file_name] = {
                     "file": file_name,
                     "status": "ABORTED",
                     "score": score,
                     "reason": f"Quality score {score} below threshold",
-                    "issues": issues
+                    "issues": run['issues']
                 }
+                del runs[file_name]
+            elif run['decision'] == "PROCEED":
+                start_load(file_name)  # nothing left to change - load in the background now
+        
+        say()
+        flush_stage()
+        
+        # ========================================
+        # STEP 4: TRANSFORMATION (if needed)
+        # ========================================
+        to_clean = [f for f in runs if runs[f]['decision'] == "CLEAN"]
+        
+        say("🧹 STEP 4: Transform Agent")
+        say("-" * 70)
+        
+        # One Gemini round trip for every cleaning strategy
+        strategy_batch = [f for f in to_clean if runs[f]['issues']]
+        try:
+            strategies = dict(zip(strategy_batch, self.safe_run(
+                self.transform.reason_batch,
+                [self.transform.strategy_prompt(runs[f]['data'], runs[f]['issues'], runs[f]['metadata'])
+                 for f in strategy_batch],
+                None,
+                self.transform.STRATEGY_MAX_TOKENS,
+                agent_name="Transform Agent"
+            )))
+        except Exception as e:
+            # The strategy is advisory only; "" keeps transform from asking Gemini per file
+            logging.warning("⚠️  Cleaning strategy batch failed, continuing without it: %s", e)
+            strategies = {file_name: "" for file_name in strategy_batch}
+        
+        def clean(file_name: str):
+            run = runs[file_name]
+            return self.safe_run(
+                self.transform.execute,
+                run['data'],
+                run['issues'],
+                strategies.get(file_name),
+                run['profile'],
+                agent_name="Transform Agent",
+                pool=self._cpu_pool
+            )
+        
+        cleaned = self._map_files(clean, [f for f in to_clean if f in runs])
+        
+        for file_name in list(runs):
+            run = runs[file_name]
             
-            print()
+            if run['decision'] != "CLEAN":
+                if verbose:
+                    say(f"⏭️  [{file_name}] Skipping transformation (high quality score: {run['score']})")
+                continue
             
-            # ========================================
-            # STEP 4: TRANSFORMATION (if needed)
-            # ========================================
-            if decision == "CLEAN":
-                print("🧹 STEP 4: Transform Agent")
-                print("-" * 70)
-                print(f"⚙️  Cleaning mediocre quality data (score: {score})...")
-                
-                trans_out = self.safe_run(
-                    self.transform.execute,
-                    data,
-                    issues,
-                    agent_name="Transform Agent"
-                )
-                
-                data = trans_out['data']
-                report = trans_out['report']
-                
-                print(f"✅ Transformation complete")
-                print(f"   Rows: {report['rows_in']} → {report['rows_out']} ({report['rows_removed']} removed)")
-                print(f"   Efficiency: {report['cleaning_efficiency']}%")
-                print(f"   Fixes applied:")
-                for fix in report['fixes_applied']:
-                    print(f"   - {fix}")
-                
-                print()
-            else:
-                print("✨ STEP 4: Transform Agent")
-                print("-" * 70)
-                print(f"⏭️  Skipping transformation (high quality score: {score})")
-                print()
+            if verbose:
+                say(f"⚙️  [{file_name}] Cleaning mediocre quality data (score: {run['score']})...")
             
-            # ========================================
-            # STEP 5: LOADING
-            # ========================================
-            print("📤 STEP 5: Loader Agent")
-            print("-" * 70)
+            trans_out, error = cleaned[file_name]
+            if error is not None:
+                fail(file_name, error)
+                continue
             
-            loader_out = self.safe_run(
-                self.loader.execute,
-                data,
-                metadata,
-                agent_name="Loader Agent"
-            )
+            # Drop the pre-clean frame and its profile so only the cleaned data stays resident
+            run['data'] = trans_out['data']
+            del run['profile']
+            report = trans_out['report']
+            self._stage_log.append({
+                "stage": "transform",
+                "file": file_name,
+                "rows_in": report['rows_in'],
+                "rows_out": report['rows_out'],
+                "fixes_applied": len(report['fixes_applied'])
+            })
+            start_load(file_name)
             
-            if loader_out['status'] == 'success':
-                print(f"✅ Successfully loaded to {loader_out['destination']}")
-                print(f"   Rows loaded: {loader_out['rows_loaded']}")
-            else:
-                print(f"❌ Load failed: {loader_out.get('error', 'Unknown error')}")
-                raise Exception(f"Load failed: {loader_out.get('error')}")
+            if verbose:
+                say(f"✅ Transformation complete")
+                say(f"   Rows: {report['rows_in']} → {report['rows_out']} ({report['rows_removed']} removed)")
+                say(f"   Efficiency: {report['cleaning_efficiency']}%")
+                say(f"   Fixes applied:")
+                for fix in report['fixes_applied']:
+                    say(f"   - {fix}")
+        
+        say()
+        flush_stage()
+        
+        # ========================================
+        # STEP 5: LOADING
+        # ========================================
+        say("📤 STEP 5: Loader Agent")
+        say("-" * 70)
+        
+        # Loads were started in STEP 3 / STEP 4; collect them
+        for file_name in list(runs):
+            run = runs[file_name]
             
-            print()
+            try:
+                loader_out = loading[file_name].result()
+                
+                if loader_out['status'] == 'success':
+                    if verbose:
+                        say(f"✅ [{file_name}] Successfully loaded to {loader_out['destination']}")
+                        say(f"   Rows loaded: {loader_out['rows_loaded']}")
+                else:
+                    if verbose:
+                        say(f"❌ [{file_name}] Load failed: {loader_out.get('error', 'Unknown error')}")
+                    raise Exception(f"Load failed: {loader_out.get('error')}")
+            except Exception as e:
+                fail(file_name, e)
+                continue
             
-            # ========================================
-            # FINAL REPORT
-            # ========================================
-            print("=" * 70)
-            print("📋 FINAL PIPELINE REPORT")
-            print("=" * 70)
+            self._stage_log.append({
+                "stage": "load",
+                "file": file_name,
+                "rows_loaded": loader_out['rows_loaded'],
+                "destination": loader_out['destination']
+            })
             
-            final_report = {
+            metadata = run['metadata']
+            results[file_name] = {
                 "file": file_name,
                 "status": "SUCCESS",
-                "quality_score": score,
-                "issues_detected": len(issues),
-                "transformation_applied": decision == "CLEAN",
+                "quality_score": run['score'],
+                "issues_detected": len(run['issues']),
+                "transformation_applied": run['decision'] == "CLEAN",
                 "rows_loaded": loader_out['rows_loaded'],
                 "schema_updated": metadata['schema_changed'],
                 "new_columns": metadata['new_columns'] if metadata['schema_changed'] else [],
                 "destination": loader_out['destination']
             }
+        
+        say()
+        flush_stage()
+        
+        # ========================================
+        # FINAL REPORT
+        # ========================================
+        if verbose:
+            say("=" * 70)
+            say("📋 FINAL PIPELINE REPORT")
+            say("=" * 70)
             
-            print(f"✅ Status: {final_report['status']}")
-            print(f"   File: {final_report['file']}")
-            print(f"   Quality Score: {final_report['quality_score']}/100")
-            print(f"   Rows Loaded: {final_report['rows_loaded']}")
-            print(f"   Transformation: {'Yes' if final_report['transformation_applied'] else 'No'}")
-            print(f"   Schema Updated: {'Yes' if final_report['schema_updated'] else 'No'}")
-            
-            if final_report['new_columns']:
-                print(f"   New Columns: {final_report['new_columns']}")
-            
-            print("=" * 70)
-            print()
-            
-            return final_report
-            
-        except Exception as e:
-            logging.error(f"💥 Pipeline failed for {file_name}: {e}")
-            print(f"\n❌ PIPELINE FAILED: {e}\n")
+            for file_name in file_names:
+                final_report = results[file_name]
+                
+                if final_report['status'] != "SUCCESS":
+                    say(f"{'⛔' if final_report['status'] == 'ABORTED' else '❌'} Status: {final_report['status']}")
+                    say(f"   File: {final_report['file']}")
+                    continue
+                
+                say(f"✅ Status: {final_report['status']}")
+                say(f"   File: {final_report['file']}")
+                say(f"   Quality Score: {final_report['quality_score']}/100")
+                say(f"   Rows Loaded: {final_report['rows_loaded']}")
+                say(f"   Transformation: {'Yes' if final_report['transformation_applied'] else 'No'}")
+                say(f"   Schema Updated: {'Yes' if final_report['schema_updated'] else 'No'}")
+                
+                if final_report['new_columns']:
+                    say(f"   New Columns: {final_report['new_columns']}")
             
-            return {
-                "file": file_name,
-                "status": "FAILED",
-                "error": str(e)
-            }
\ No newline at end of file
+            say("=" * 70)
+            say()
+        flush_stage()
+        
+        # One structured record for the whole run instead of a line per stage event
+        run_record = {
+            "files": {file_name: results[file_name]['status'] for file_name in file_names},
+            "stages": self._stage_log
+        }
+        # Serializing the whole run is only worth it when the record will be emitted
+        if logging.getLogger().isEnabledFor(logging.INFO):
+            logging.info("📋 pipeline_run %s", to_json(run_record), extra={"stages": self._stage_log})
+        self._save_routing_table()
+        
+        return [results[file_name] for file_name in file_names]